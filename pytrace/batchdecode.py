@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+  Offline decoding of raw SWO dump files (ST-Link capture, OpenOCD tpiu file
+  output, logic analyser export) using all the cores on the box.
+
+  The dump is split at ITM sync packets; the byte after a sync packet is
+  always a packet header so each segment decodes stand alone, and as every
+  byte belongs to exactly one segment no packet is lost or counted twice.
+  The segments are decoded in a process pool and the results merged in file
+  order.
+"""
+
+import json
+import mmap
+import os
+import shutil
+from collections import Counter
+from multiprocessing import Pool
+
+from pytrace import tpiuparser
+
+READ_BLOCK = 1024 * 1024
+
+
+def findSyncPoints(mm):
+    """Return the offsets just after every ITM sync packet in mm."""
+    points = []
+    idx = mm.find(tpiuparser.SYNC_PACKET)
+    while idx >= 0:
+        points.append(idx + len(tpiuparser.SYNC_PACKET))
+        idx = mm.find(tpiuparser.SYNC_PACKET, idx + len(tpiuparser.SYNC_PACKET))
+    return points
+
+
+def splitSegments(size, syncPoints, segments):
+    """Pick at most 'segments' (start, end) byte ranges covering [0, size), each
+    range after the first starting at a sync point."""
+    bounds = [0]
+    if segments > 1:
+        target = size / segments
+        nextCut = target
+        for p in syncPoints:
+            if p >= nextCut and p < size:
+                bounds.append(p)
+                nextCut = p + target
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _eventRecord(ev, data):
+    rec = {"event": ev}
+    if isinstance(data, tpiuparser.SITData):
+        rec["chan"] = data.chan
+        rec["lth"] = data.lth
+        rec["value"] = data.sum
+    elif isinstance(data, tpiuparser.HSPData):
+        rec["disc"] = data.discriminator
+        rec["lth"] = data.lth
+        rec["value"] = data.value
+        if data.type == tpiuparser.Type.EXCEPTION_TRACE:
+            rec["exc"] = data.data[0] + ((data.data[1] & 0x01) << 8) - 16
+            rec["func"] = (data.data[1] & 0x30) >> 4
+        elif hasattr(data, "dwtIndex"):
+            rec["dwt"] = data.dwtIndex
+    return rec
+
+
+def _decodeSegment(args):
+    """Process pool worker, decode one byte range of the dump file."""
+    path, index, start, end, partFile = args
+    counts = Counter()
+    pcHist = Counter()
+    out = open(partFile, "w") if partFile else None
+
+    def onEvent(ev, data=None):
+        counts[ev] += 1
+        if ev == "HSP_PC_SAMPLE" and data.lth == 4:
+            pcHist[data.value] += 1
+        if out:
+            out.write(json.dumps(_eventRecord(ev, data)))
+            out.write("\n")
+
+    sm = tpiuparser.TPIUParserSM()
+    sm.onEvent = onEvent
+    if index > 0:
+        # segment begins straight after a sync packet, so the target sends them
+        sm.syncSeen = True
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(READ_BLOCK, remaining))
+            if not block:
+                break
+            sm.parseBytes(block)
+            remaining -= len(block)
+    if out:
+        out.close()
+    return {"counts": counts, "pcHist": pcHist, "stats": sm.getStats()}
+
+
+def resolveProfile(pcHist, elfFiles):
+    """Turn a histogram of raw PC values into one of function names, only
+    asking addr2line once per distinct address."""
+    addr2line = tpiuparser.Address2LineResolver(elfFiles)
+    gprof = Counter()
+    for addr, n in pcHist.items():
+        name = addr2line.resolve(addr) or "{:08x}".format(addr)
+        gprof[name] += n
+    return gprof
+
+
+def decodeFile(path, jobs=None, elfFiles=(), jsonOut=None):
+    """Decode a raw SWO dump in parallel, returns a dict of merged results:
+        counts: events by name, gprof: PC samples by function,
+        stats: stream health counters, segments: number of segments."""
+    jobs = jobs or os.cpu_count() or 1
+    size = os.path.getsize(path)
+    if size == 0:
+        syncPoints = []
+    else:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            syncPoints = findSyncPoints(mm)
+    # a few segments per worker keeps the pool busy if sync points are uneven
+    ranges = splitSegments(size, syncPoints, jobs * 4)
+    work = []
+    for i, (start, end) in enumerate(ranges):
+        partFile = "{}.part{}".format(jsonOut, i) if jsonOut else None
+        work.append((path, i, start, end, partFile))
+
+    with Pool(min(jobs, len(work))) as pool:
+        results = pool.map(_decodeSegment, work)
+
+    counts = Counter()
+    pcHist = Counter()
+    stats = Counter()
+    for r in results:
+        counts.update(r["counts"])
+        pcHist.update(r["pcHist"])
+        stats.update(r["stats"])
+
+    if jsonOut:
+        with open(jsonOut, "w") as out:
+            for w in work:
+                with open(w[4]) as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(w[4])
+
+    return {"counts": counts,
+            "gprof": resolveProfile(pcHist, elfFiles) if pcHist else Counter(),
+            "stats": dict(stats),
+            "segments": len(ranges),
+            "syncPoints": len(syncPoints)}
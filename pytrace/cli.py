@@ -2,9 +2,15 @@
 
 import click
 import signal
-from pytrace import stlinktrace, tpiuparser
+from pytrace import (stlinktrace, tpiuparser, batchdecode, profbaseline, soak as soakmode, dashboard, consoleio,
+                     watchscheduler)
+import contextlib
+import os
+import stat
+import threading
 import time
 import subprocess
+import sys
 
 class GracefulInterruptHandler(object):
     """This is a context manager that hooks some signals and captures if they
@@ -62,7 +68,84 @@ class WatchPointManager(object):
         getData = 'd' in flags
         getPC = 'p' in flags
         getOffset = 'o' in flags
-        self.trace.setWatch(index, addr, size=size, getData=getData, getPC=getPC, getOffset=getOffset)
+        label = sym or "{:08x}".format(addr)
+        return self.trace.setWatch(index, addr, size=size, getData=getData, getPC=getPC, getOffset=getOffset,
+                                   tag=(label, flags))
+
+    def clearWatch(self, index):
+        return self.trace.setWatch(index, 0, getData=False, tag=(None, ""))
+
+class ControlChannel(object):
+    """Reads reconfiguration commands, one per line, from a named pipe while
+    capture runs, e.g. 'echo "watch 1 motorState dwu" > ctl':
+        watch <index> <sym|0xaddr> [flags] [size]
+        unwatch <index>
+        isr 0|1
+        prof 0|1
+    The changes go via the stlink pump thread and are confirmed by a marker line in the output.
+    Comparators in reserved (owned by the --watch scheduler) can't be changed."""
+
+    def __init__(self, path, trace, watchPointMgr, reserved=()):
+        self.path = path
+        self.trace = trace
+        self.watchPointMgr = watchPointMgr
+        self.reserved = set(reserved)
+        if not os.path.exists(path):
+            os.mkfifo(path)
+        elif not stat.S_ISFIFO(os.stat(path).st_mode):
+            # a plain file never blocks, its commands would be re-run forever
+            raise click.UsageError("--control {} exists and is not a named pipe".format(path))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            # open blocks until a writer turns up, EOF when it closes
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        self.execute(line.split())
+                    except (ValueError, IndexError) as e:
+                        print("!! bad control command [{}]: {}".format(line.strip(), e))
+
+    def _index(self, word):
+        index = int(word)
+        if index not in range(4):
+            raise ValueError("DWT index must be 0-3")
+        if index in self.reserved:
+            raise ValueError("DWT{} is used by the --watch scheduler".format(index))
+        return index
+
+    def execute(self, words):
+        if not words:
+            return
+        cmd = words[0]
+        if cmd == "watch":
+            index = self._index(words[1])
+            target = words[2]
+            flags = words[3] if len(words) > 3 else "dp"
+            size = words[4] if len(words) > 4 else None
+            if target.startswith("0x"):
+                self.watchPointMgr.setupWatch(index, None, target, size, flags)
+            elif self.watchPointMgr.elfinspector.name2addr(target) is None:
+                raise ValueError("unknown symbol {}".format(target))
+            else:
+                self.watchPointMgr.setupWatch(index, target, None, size, flags)
+        elif cmd == "unwatch":
+            self.watchPointMgr.clearWatch(self._index(words[1]))
+        elif cmd == "isr":
+            self.trace.setExceptionTracing(int(words[1]))
+        elif cmd == "prof":
+            self.trace.setProfiling(int(words[1]))
+        else:
+            raise ValueError("unknown command")
+
+def parse_watches(ctx, param, value):
+    """--watch callback, SYM[:flags[:priority]] specs to ScheduledWatch."""
+    try:
+        return [watchscheduler.ScheduledWatch.parse(spec) for spec in value]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
 
 _global_options = [
     click.option('--xtal',   default=72,     help='XTAL frequency of target in MHz'),
@@ -87,6 +170,16 @@ _global_options = [
 	click.option('--addr3',  default=None,   help='address IN HEX to watch on DWT3'),
 	click.option('--size3',  default=None,   help='number of bytes IN DEC to watch on DWT3 (defaults to size in map constrained to 2**n OR 4 if addr set explicitly via --addr3)'),
 	click.option('--flags3', default="dp",   help='flags to control DWT reporting, d: data, p: PC, o: offset, r: reads, w: writes, u: unique only'),
+	click.option('--qfstats', default=0,     help='report QF active object run-to-completion statistics on exit'),
+	click.option('--qftrace', default=None,
+	             help='write QF active object timeline to this file (chrome://tracing / Perfetto JSON)'),
+	click.option('--control', default=None,  help='named pipe to read watch/isr/prof commands from while capturing'),
+	click.option('--watch',   multiple=True, callback=parse_watches,
+	             help='SYM[:flags[:priority]] to watch, time shared over DWT comparators not used by --sym/--addr'
+	                  ' (repeatable)'),
+	click.option('--slice',   default=1.0,   help='seconds each --watch set stays on the comparators'),
+	click.option('--policy',  default="round-robin", type=click.Choice(watchscheduler.POLICIES),
+	             help='how --watch symbols are picked for each slice'),
 ]
 
 def global_options(func):
@@ -106,6 +199,44 @@ def log(**kwargs):
     """Capture SWO trace output from stlink V2"""
     run_trace(**kwargs)
 
+@cmnds.command()
+@global_options
+@click.option('--logdir',       default="soak", help='directory for the rotated, compressed trace output and snapshots')
+@click.option('--rotate-mb',    default=100.0,  help='start a new output file after this many MB (uncompressed)')
+@click.option('--rotate-hours', default=0.0,    help='start a new output file after this many hours (0: size only)')
+@click.option('--keep',         default=50,     help='number of output files to keep')
+@click.option('--snapshot',     default=60.0,   help='seconds between statistics snapshots')
+def soak(logdir, rotate_mb, rotate_hours, keep, snapshot, **kwargs):
+    """Capture for days with flat memory, rotating compressed output and periodic snapshots"""
+    if kwargs['qftrace']:
+        raise click.UsageError("--qftrace keeps the whole QF timeline in memory, not available in soak mode")
+    opened = open_trace(**kwargs)
+    if opened:
+        trace, parser = opened
+        maxAge = rotate_hours * 3600 or None
+        out = soakmode.RotatingOutput(os.path.join(logdir, "trace"), int(rotate_mb * 1e6), maxAge, keep)
+        # snapshots are small, size only rotation keeps the whole run's history
+        snapshots = soakmode.RotatingOutput(os.path.join(logdir, "snapshots"),
+                                            soakmode.SNAPSHOT_FILE_BYTES, None, soakmode.SNAPSHOT_KEEP)
+        monitor = soakmode.SoakMonitor(parser, trace, snapshots, snapshot)
+        with contextlib.redirect_stdout(out):
+            pump_trace(trace, parser, monitor.poll)
+        monitor.snapshot()
+        out.close()
+        snapshots.close()
+
+@cmnds.command()
+@global_options
+@click.option('--fps',  default=4,       help='screen redraws per second')
+@click.option('--idle', multiple=True,   help='idle function name, not counted as busy (repeatable)')
+def top(fps, idle, **kwargs):
+    """Live top-style view of profile, ISR rates, DWT watches and link health"""
+    opened = open_trace(parserClass=dashboard.LiveModel, **kwargs)
+    if opened:
+        trace, model = opened
+        with consoleio.Conio() as conio:
+            dashboard.Dashboard(trace, model, conio, fps, idle, kwargs['isr'], kwargs['prof']).run()
+
 @cmnds.command()
 @global_options
 def target(**kwargs):
@@ -119,38 +250,178 @@ def target(**kwargs):
         voltage = target.getTargetVoltage()
         print("ID: {:#X}\nVoltage: {:.4}".format(id, voltage))
 
-def run_trace(xtal, baud, isr, prof, elf0, elf1, sym0, addr0, size0, sym1, addr1, size1, sym2, addr2, size2, sym3, addr3, size3, flags0, flags1, flags2, flags3):
-    """Capture SWO trace output from stlink V2"""
+@cmnds.command()
+@click.argument('dump', type=click.Path(exists=True, dir_okay=False))
+@click.option('--jobs',  default=None, type=int, help='number of decode processes (defaults to number of cores)')
+@click.option('--elf0',  default=None,
+              help='an application loaded on target, eg bootstrapper (for resolving PC samples)')
+@click.option('--elf1',  default=None, help='application loaded on target eg main app (for resolving PC samples)')
+@click.option('--json',  'json_out', default=None,
+              help='write every decoded packet, in order, to this file as JSON lines')
+@click.option('--top',   default=20, help='number of functions to list from the PC sample profile')
+def decode(dump, jobs, elf0, elf1, json_out, top):
+    """Decode a raw SWO dump file in parallel, split at ITM sync packets.
+
+    A dump with no sync packets (ITM_TCR.SYNCENA or DWT_CTRL.SYNCTAP off, e.g.
+    captured with an older pytrace) decodes as a single segment on one core."""
+    result = batchdecode.decodeFile(dump, jobs=jobs, elfFiles=(elf0, elf1), jsonOut=json_out)
+    if result["syncPoints"] == 0:
+        print("!! no ITM sync packets in dump, decoded as a single segment.")
+    print("decoded {} segments".format(result["segments"]))
+    print("events:")
+    for ev, n in sorted(result["counts"].items()):
+        print("  {:<24} {}".format(ev, n))
+    print("stream: {}".format(result["stats"]))
+    gprof = result["gprof"]
+    if gprof:
+        total = sum(gprof.values())
+        print("profile ({} samples):".format(total))
+        for name, n in gprof.most_common(top):
+            print("  {:6.2f}%  {:8}  {}".format(100.0 * n / total, n, name))
+
+@cmnds.command()
+@click.option('--xtal',      default=72,     help='XTAL frequency of target in MHz')
+@click.option('--baud',      default=250000, help='Baud rate for SWO from target (2000000 max)')
+@click.option('--elf0',      default=None,
+              help='an application loaded on target, eg bootstrapper (for resolving PC samples)')
+@click.option('--elf1',      default=None,   help='application loaded on target eg main app (for resolving PC samples)')
+@click.option('--dump',      default=None,   help='take PC samples from this raw SWO dump file rather than the stlink')
+@click.option('--duration',  default=None, type=float,
+              help='seconds of samples to collect from the stlink (not with --dump)')
+@click.option('--samples',   default=None, type=int,   help='number of samples to collect')
+@click.option('--idle',      multiple=True,  help='idle function name, not counted as busy (repeatable)')
+@click.option('--save',      default=None,   help='save the profile as a baseline in this directory')
+@click.option('--baseline',  default=None,
+              help='compare against this baseline file (or newest baseline in directory)')
+@click.option('--max-share', default=1.0,
+              help='percentage points a function share may grow before it is a regression')
+@click.option('--max-busy',  default=2.0,    help='percentage points CPU busy may grow before it is a regression')
+@click.option('--alpha',     default=0.01,   help='significance level for an increase to count')
+def profile(xtal, baud, elf0, elf1, dump, duration, samples, idle, save, baseline, max_share, max_busy, alpha):
+    """Collect a PC sample profile, save it as a baseline or gate it against one"""
+    if dump and duration:
+        raise click.UsageError("--duration is wall clock time, use --samples to limit a --dump")
+    if not (duration or samples or dump):
+        duration = 10
+    base = None
+    if baseline:
+        # before capturing, and before saving so '--save d --baseline d' gates against the previous one
+        try:
+            base = profbaseline.Profile.load(baseline)
+        except (ValueError, KeyError, OSError) as e:
+            # exit 2, 1 means regressed
+            raise click.UsageError("bad --baseline: {}".format(e))
+    if dump:
+        pcHist, sleeps = profbaseline.collectPCSamples(profbaseline.dumpChunks(dump), samples)
+    else:
+        try:
+            trace = stlinktrace.StlinkTrace(xtal, baud)
+        except Exception as e:
+            print("NO STLINK! exiting. {}".format(e))
+            sys.exit(2)
+        trace.setProfiling(1)
+        with GracefulInterruptHandler() as h:
+            def chunks():
+                while not h.interrupted:
+                    yield trace.readSWO()
+            trace.startSWO()
+            try:
+                pcHist, sleeps = profbaseline.collectPCSamples(chunks(), samples, duration)
+            finally:
+                trace.stopSWO()
+
+    new = profbaseline.Profile.fromSamples(pcHist, sleeps, (elf0, elf1), idle)
+    total = new.total()
+    print("{} samples, busy {:.1f}%".format(total, 100.0 * new.busy()))
+    for name, n in new.functions.most_common(20):
+        print("  {:6.2f}%  {:8}  {}".format(100.0 * n / total, n, name))
+    regressions = []
+    if base:
+        base.idle = new.idle = new.idle or base.idle
+        print("against baseline {} ({}), busy {:.1f}%".format(base.build.get("key"), base.created, 100.0 * base.busy()))
+        regressions = profbaseline.compare(base, new, max_share, max_busy, alpha)
+        for r in regressions:
+            print("!! REGRESSION {}: {:.2f}% -> {:.2f}% (p={:.2g})".format(r["name"], r["base"], r["new"], r["p"]))
+    if regressions:
+        print("regressed, not saving as a baseline")
+        sys.exit(1)
+    if base:
+        print("no regressions")
+    if save:
+        print("baseline saved to {}".format(new.save(save)))
+
+def open_trace(xtal, baud, isr, prof, elf0, elf1,
+               sym0, addr0, size0, sym1, addr1, size1, sym2, addr2, size2, sym3, addr3, size3,
+               flags0, flags1, flags2, flags3, qfstats, qftrace, control, watch, slice, policy,
+               parserClass=tpiuparser.TPIUParser):
+    """Connect to the stlink and set up watches, tracing and the control pipe, returns (trace, parser)
+    or None if no stlink."""
+    fixed = [sym0 or addr0, sym1 or addr1, sym2 or addr2, sym3 or addr3]
+    free = [i for i in range(4) if not fixed[i]]
+    if watch and not free:
+        raise click.UsageError("--watch needs a DWT comparator not taken by --sym/--addr")
     try:
         trace = stlinktrace.StlinkTrace(xtal, baud)
     except Exception as e:
         print("NO STLINK! exiting. {}".format(e))
-    else:
-        watchPointMgr = WatchPointManager(trace, (elf0, elf1))
-        if sym0 or addr0:
-            watchPointMgr.setupWatch(0, sym0, addr0, size0, flags0)
-        if sym1 or addr1:
-            watchPointMgr.setupWatch(1, sym1, addr1, size1, flags1)
-        if sym2 or addr2:
-            watchPointMgr.setupWatch(2, sym2, addr2, size2, flags2)
-        if sym3 or addr3:
-            watchPointMgr.setupWatch(3, sym3, addr3, size3, flags3)
-        trace.setExceptionTracing(isr)
-        trace.setProfiling(prof)
-        parser = tpiuparser.TPIUParser([sym0, sym1, sym2, sym3], [flags0, flags1, flags2, flags3], [elf0, elf1])
+        return None
+    watchPointMgr = WatchPointManager(trace, (elf0, elf1))
+    if sym0 or addr0:
+        watchPointMgr.setupWatch(0, sym0, addr0, size0, flags0)
+    if sym1 or addr1:
+        watchPointMgr.setupWatch(1, sym1, addr1, size1, flags1)
+    if sym2 or addr2:
+        watchPointMgr.setupWatch(2, sym2, addr2, size2, flags2)
+    if sym3 or addr3:
+        watchPointMgr.setupWatch(3, sym3, addr3, size3, flags3)
+    trace.setExceptionTracing(isr)
+    trace.setProfiling(prof)
+    parser = parserClass([sym0, sym1, sym2, sym3], [flags0, flags1, flags2, flags3], [elf0, elf1],
+                         qfTimeline=bool(qftrace))
+    if watch:
+        parser.watchScheduler = watchscheduler.WatchScheduler(watchPointMgr, watch, free, slice, policy)
+    if control:
+        reserved = parser.watchScheduler.comparators if parser.watchScheduler else ()
+        ControlChannel(control, trace, watchPointMgr, reserved)
+    return trace, parser
 
-        with GracefulInterruptHandler() as h:
-            trace.startSWO()  # while SWO active NO other calls than stopSWO and readSWO allowed
-            try:
-                while True:
-                    swo = trace.readSWO()
-                    if swo:
-                        parser.parseBytes(swo)
-                    if h.interrupted:
-                        print("CAUGHT Linux signal - terminating.")
-                        print("stopping SWO")
-                        trace.stopSWO()
-                        break
-            except:
-                trace.stopSWO()
+def pump_trace(trace, parser, poll=None):
+    """Decode SWO until a Linux signal, calling poll() after every read."""
+    with GracefulInterruptHandler() as h:
+        trace.startSWO()  # while SWO active probe changes are queued to the pump thread
+        try:
+            while True:
+                swo, hostTime = trace.readSWOTimed()
+                if swo:
+                    parser.parseBytes(swo, hostTime)
+                if parser.watchScheduler:
+                    parser.watchScheduler.poll()
+                if poll:
+                    poll()
+                if h.interrupted:
+                    print("CAUGHT Linux signal - terminating.")
+                    print("stopping SWO")
+                    trace.stopSWO()
+                    break
+        except KeyboardInterrupt:
+            trace.stopSWO()
+        except BaseException:
+            # e.g. disk full in soak output, stop the stlink but don't hide it
+            trace.stopSWO()
+            raise
+
+def run_trace(**kwargs):
+    """Capture SWO trace output from stlink V2"""
+    opened = open_trace(**kwargs)
+    if opened:
+        trace, parser = opened
+        pump_trace(trace, parser)
         print("we got:\n{}".format(parser.getGprof()))
+        print("stream: {}".format(parser.getStats()))
+        if parser.watchScheduler:
+            print(parser.watchScheduler.formatReport())
+        if kwargs['qfstats']:
+            print(parser.qf.formatReport())
+        if kwargs['qftrace']:
+            parser.qf.exportTrace(kwargs['qftrace'])
+            print("QF timeline written to {}".format(kwargs['qftrace']))
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+  'top' style live view of a trace.
+
+  Decoding runs in its own thread into LiveModel, a TPIUParser that only
+  aggregates (no per event printing).  The Dashboard redraws from the
+  aggregates at a fixed frame rate, so rendering cost does not depend on the
+  event rate and never holds up decoding.
+"""
+
+import sys
+import threading
+import time
+from array import array
+
+from pytrace import tpiuparser
+
+PANELS = ["profile", "isr", "dwt", "link"]
+EXC_NAMES = {-15: "Reset", -14: "NMI", -13: "HardFault", -12: "MemManage", -11: "BusFault",
+             -10: "UsageFault", -5: "SVCall", -4: "DebugMon", -2: "PendSV", -1: "SysTick"}
+
+
+class DWTWatch(object):
+    """current and aggregate value of one DWT comparator."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.last = None
+        self.min = None
+        self.max = None
+        self.reads = 0
+        self.writes = 0
+
+    def add(self, value, isWrite):
+        self.last = value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if isWrite:
+            self.writes += 1
+        else:
+            self.reads += 1
+
+
+class LiveModel(tpiuparser.TPIUParser):
+    """TPIUParser that keeps aggregate state for the dashboard instead of printing events."""
+
+    def __init__(self, syms, flags, elfFiles=None, qfTimeline=False):
+        tpiuparser.TPIUParser.__init__(self, syms, flags, elfFiles, qfTimeline)
+        self.bytes = 0
+        self.sits = 0
+        self.excEntries = {}
+        self.dwt = [DWTWatch() for i in range(4)]
+        self.lastMarker = None
+
+    def parseBytes(self, bytes, hostTime=None):
+        if not isinstance(bytes, tpiuparser.Marker):
+            self.bytes += len(bytes)
+        tpiuparser.TPIUParser.parseBytes(self, bytes, hostTime)
+
+    def onMarker(self, ev, marker):
+        self.lastMarker = marker
+        if marker.command == "setWatch" and marker.tag and not marker.error:
+            sym, flags = marker.tag
+            self.setWatchDisplay(marker.args["index"], sym, flags)
+            self.dwt[marker.args["index"]].reset()
+        if self.watchScheduler:
+            self.watchScheduler.onMarker(marker)
+
+    def onOverflow(self, ev, data):
+        self._totalOverflows += 1
+
+    def onSyncLost(self, ev, data):
+        pass
+
+    def onExcTrace(self, ev, hsp):
+        if (hsp.data[1] & 0x30) >> 4 == 1:
+            # ENTER
+            exc = hsp.data[0] + ((hsp.data[1] & 0x01) << 8) - 16
+            self.excEntries[exc] = self.excEntries.get(exc, 0) + 1
+
+    def onPC(self, ev, hsp):
+        if ev != "HSP_PC_SAMPLE":
+            # PC of a DWT data access, not a profile sample
+            return
+        if hsp.lth == 1:
+            self.sleeps += 1
+        else:
+            self.funcHist.add(hsp.value)
+
+    def onData(self, ev, hsp):
+        self.dwt[hsp.dwtIndex].add(hsp.value, hsp.isWrite)
+        if self.watchScheduler:
+            self.watchScheduler.onData(hsp.dwtIndex, hsp.isWrite)
+
+    def onOffset(self, ev, hsp):
+        pass
+
+    def onSIT(self, ev, sit):
+        self.sits += 1
+
+
+class Dashboard(object):
+    """Renders a LiveModel to the terminal and handles the keyboard:
+        q quit, space pause, tab/1-4 panel, r reset, e exception tracing, p profiling."""
+
+    def __init__(self, trace, model, conio, fps=4, idle=(), isr=False, prof=False, top=15):
+        self.trace = trace
+        self.model = model
+        self.conio = conio
+        self.fps = fps
+        self.idle = set(idle)
+        self.isr = bool(isr)
+        self.prof = bool(prof)
+        self.top = top
+        self.panel = 0
+        self.paused = False
+        self._running = False
+        self._decoder = None
+        self._decodeError = None
+        self._baseCounts = array('Q', model.funcHist.counts)
+        self._baseSleeps = 0
+        self._rates = {}
+        self._linkRate = 0
+        self._prevExc = {}
+        self._prevBytes = 0
+        self._prevRateTime = time.monotonic()
+
+    def _decode(self):
+        try:
+            while self._running:
+                swo, hostTime = self.trace.readSWOTimed()
+                if swo:
+                    self.model.parseBytes(swo, hostTime)
+                if self.model.watchScheduler:
+                    self.model.watchScheduler.poll()
+        except Exception as e:
+            # run() re-raises it in the main thread, ending the dashboard
+            self._decodeError = e
+
+    def _startCapture(self):
+        self._running = True
+        self.trace.startSWO()
+        self._decoder = threading.Thread(target=self._decode)
+        self._decoder.start()
+
+    def _stopCapture(self):
+        self._running = False
+        self.trace.stopSWO()
+        self._decoder.join()
+
+    def run(self):
+        self._startCapture()
+        try:
+            period = 1.0 / self.fps
+            while True:
+                frameStart = time.monotonic()
+                if self._decodeError:
+                    raise self._decodeError
+                while self.conio.kbhit():
+                    if not self.onKey(self.conio.getch()):
+                        return
+                self._updateRates()
+                if not self.paused:
+                    self.draw()
+                time.sleep(max(0, period - (time.monotonic() - frameStart)))
+        finally:
+            self._stopCapture()
+
+    def onKey(self, key):
+        if key in ("q", "\x03"):
+            return False
+        elif key == " ":
+            self.paused = not self.paused
+            self.draw()
+        elif key == "\t":
+            self.panel = (self.panel + 1) % len(PANELS)
+        elif key in "1234":
+            self.panel = int(key) - 1
+        elif key == "r":
+            self._baseCounts = array('Q', self.model.funcHist.counts)
+            self._baseSleeps = self.model.sleeps
+            for w in self.model.dwt:
+                w.reset()
+        elif key == "e":
+            self.isr = not self.isr
+            self.trace.setExceptionTracing(self.isr)
+        elif key == "p":
+            self.prof = not self.prof
+            self.trace.setProfiling(self.prof)
+        return True
+
+    def _updateRates(self):
+        """once a second, turn counts into rates."""
+        now = time.monotonic()
+        dt = now - self._prevRateTime
+        if dt < 1.0:
+            return
+        exc = dict(self.model.excEntries)
+        self._rates = {k: (n - self._prevExc.get(k, 0)) / dt for k, n in exc.items()}
+        self._prevExc = exc
+        self._linkRate = (self.model.bytes - self._prevBytes) / dt
+        self._prevBytes = self.model.bytes
+        self._prevRateTime = now
+
+    def draw(self):
+        lines = ["pytrace top  [{}]  {}{}".format(
+            " ".join(n.upper() if i == self.panel else n for i, n in enumerate(PANELS)),
+            "PAUSED " if self.paused else "", self.model.lastMarker or "")]
+        lines.append("isr {}  prof {}   q:quit space:pause tab/1-4:panel r:reset e:isr p:prof".format(
+            "ON" if self.isr else "off", "ON" if self.prof else "off"))
+        lines.append("")
+        lines += getattr(self, "_panel_" + PANELS[self.panel])()
+        sys.stdout.write("\x1b[H\x1b[2J" + "\r\n".join(lines) + "\r\n")
+        sys.stdout.flush()
+
+    def _panel_profile(self):
+        counts = array('Q', (n - b for n, b in zip(self.model.funcHist.counts, self._baseCounts)))
+        hist = self.model.funcHist.toDict(counts)
+        sleeps = self.model.sleeps - self._baseSleeps
+        total = sum(hist.values()) + sleeps
+        if not total:
+            return ["no PC samples (p to enable profiling)"]
+        idle = sleeps + sum(n for name, n in hist.items() if name in self.idle)
+        lines = ["CPU busy {:5.1f}%   {} samples".format(100.0 * (total - idle) / total, total)]
+        for name, n in sorted(hist.items(), key=lambda kv: kv[1], reverse=True)[:self.top]:
+            lines.append("  {:6.2f}%  {:8}  {}".format(100.0 * n / total, n, name))
+        return lines
+
+    def _panel_isr(self):
+        if not self._rates:
+            return ["no exceptions (e to enable exception tracing)"]
+        lines = ["  {:>5}  {:<12} {:>10} {:>10}".format("exc", "", "rate/s", "total")]
+        for exc, rate in sorted(self._rates.items(), key=lambda kv: kv[1], reverse=True)[:self.top]:
+            lines.append("  {:>5}  {:<12} {:>10.1f} {:>10}".format(
+                exc, EXC_NAMES.get(exc, ""), rate, self.model.excEntries.get(exc, 0)))
+        return lines
+
+    def _panel_dwt(self):
+        def fmt(v):
+            return "-" if v is None else "{:x}".format(v)
+
+        lines = ["  {:<4} {:<24} {:>10} {:>10} {:>10} {:>8} {:>8}".format(
+            "", "watch", "now", "min", "max", "writes", "reads")]
+        for i, w in enumerate(self.model.dwt):
+            label = self.model.syms[i] or ""
+            lines.append("  DWT{} {:<24} {:>10} {:>10} {:>10} {:>8} {:>8}".format(
+                i, label, fmt(w.last), fmt(w.min), fmt(w.max), w.writes, w.reads))
+        return lines
+
+    def _panel_link(self):
+        stats = self.model.getStats()
+        lines = ["  {:<16} {:.0f} bytes/s".format("SWO rate", self._linkRate),
+                 "  {:<16} {}".format("dropped reads", self.trace.droppedReads)]
+        for k in sorted(stats):
+            lines.append("  {:<16} {}".format(k, stats[k]))
+        return lines
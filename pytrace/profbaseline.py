@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+  PC sample profile baselines, for catching firmware performance regressions.
+
+  A profile is the number of PC samples that landed in each function.  It is
+  saved as a versioned JSON baseline named after the build ID of the ELF
+  file(s) it was taken on, and a later run is compared against it function by
+  function with a one sided two proportion z-test on the sample share, so a
+  function only counts as a regression if it got hotter by more than the
+  threshold AND the increase is statistically significant.
+"""
+
+import datetime
+import glob
+import hashlib
+import json
+import math
+import os
+import time
+from collections import Counter
+from subprocess import PIPE, run
+
+from pytrace import tpiuparser, batchdecode
+
+FORMAT_VERSION = 1
+SLEEP = "<sleep>"   # 1 byte PC sample packets, core was sleeping
+
+
+def buildId(elfFile):
+    """GNU build ID of an ELF file, or a hash of its contents if it has none."""
+    try:
+        notes = run(["readelf", "-n", elfFile], stdout=PIPE, universal_newlines=True).stdout
+    except OSError:
+        notes = ""
+    for line in notes.splitlines():
+        if "Build ID:" in line:
+            return line.split("Build ID:")[1].strip()
+    with open(elfFile, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def buildKey(elfFiles):
+    return "-".join(buildId(elf)[:16] for elf in elfFiles if elf)
+
+
+def collectPCSamples(chunks, samples=None, duration=None):
+    """Count PC samples by address from an iterable of SWO byte buffers until
+    the sample count or duration (wall clock seconds, so live capture only)
+    is reached, or the chunks run out."""
+    pcHist = Counter()
+    sleeps = [0]
+    total = [0]
+
+    def onEvent(ev, data=None):
+        if ev == "HSP_PC_SAMPLE" and not (samples and total[0] >= samples):
+            total[0] += 1
+            if data.lth == 4:
+                pcHist[data.value] += 1
+            else:
+                sleeps[0] += 1
+
+    sm = tpiuparser.TPIUParserSM()
+    sm.onEvent = onEvent
+    start = time.monotonic()
+    for chunk in chunks:
+        if chunk:
+            sm.parseBytes(chunk)
+        if samples and total[0] >= samples:
+            break
+        if duration and time.monotonic() - start >= duration:
+            break
+    return pcHist, sleeps[0]
+
+
+def dumpChunks(path, blockSize=4096):
+    with open(path, "rb") as f:
+        block = f.read(blockSize)
+        while block:
+            yield block
+            block = f.read(blockSize)
+
+
+class Profile(object):
+    """Function name -> PC sample count, plus the build it was taken on."""
+
+    def __init__(self, functions, idle=(), build=None, created=None):
+        self.functions = Counter(functions)
+        self.idle = list(idle)
+        self.build = build or {}
+        self.created = created or datetime.datetime.now().isoformat(timespec="seconds")
+
+    @classmethod
+    def fromSamples(cls, pcHist, sleeps, elfFiles, idle=()):
+        functions = batchdecode.resolveProfile(pcHist, elfFiles)
+        if sleeps:
+            functions[SLEEP] = sleeps
+        build = {"key": buildKey(elfFiles), "elf": [elf for elf in elfFiles if elf]}
+        return cls(functions, idle, build)
+
+    def total(self):
+        return sum(self.functions.values())
+
+    def share(self, name):
+        total = self.total()
+        return self.functions.get(name, 0) / total if total else 0
+
+    def idleSamples(self):
+        return sum(n for name, n in self.functions.items() if name == SLEEP or name in self.idle)
+
+    def busy(self):
+        """Fraction of samples not sleeping or in an idle function."""
+        total = self.total()
+        return 1 - self.idleSamples() / total if total else 0
+
+    def save(self, baselineDir):
+        os.makedirs(baselineDir, exist_ok=True)
+        path = os.path.join(baselineDir, "{}.json".format(self.build.get("key") or "unknown"))
+        with open(path, "w") as f:
+            json.dump({"format": FORMAT_VERSION, "build": self.build, "created": self.created,
+                       "idle": self.idle, "functions": dict(self.functions)}, f, indent=1, sort_keys=True)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """Load a baseline file, or the newest baseline in a directory."""
+        if os.path.isdir(path):
+            files = glob.glob(os.path.join(path, "*.json"))
+            if not files:
+                raise ValueError("no baselines in {}".format(path))
+            path = max(files, key=os.path.getmtime)
+        with open(path) as f:
+            rec = json.load(f)
+        if rec.get("format") != FORMAT_VERSION:
+            raise ValueError("{} is baseline format {}, expected {}".format(path, rec.get("format"), FORMAT_VERSION))
+        return cls(rec["functions"], rec.get("idle", ()), rec.get("build"), rec.get("created"))
+
+
+def increasePValue(count1, total1, count2, total2):
+    """One sided p-value that proportion 2 is greater than proportion 1 (pooled z-test)."""
+    if not total1 or not total2:
+        return 1.0
+    p1 = count1 / total1
+    p2 = count2 / total2
+    pooled = (count1 + count2) / (total1 + total2)
+    se = math.sqrt(pooled * (1 - pooled) * (1 / total1 + 1 / total2))
+    if se == 0:
+        return 1.0
+    z = (p2 - p1) / se
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def compare(base, new, maxShareIncrease=1.0, maxBusyIncrease=2.0, alpha=0.01):
+    """Compare new profile to baseline, returns list of regressions as dicts
+    (name, base %, new %, p-value).  Thresholds are in percentage points."""
+    regressions = []
+    bt = base.total()
+    nt = new.total()
+    for name in set(base.functions) | set(new.functions):
+        if name == SLEEP or name in new.idle:
+            continue
+        b = base.functions.get(name, 0)
+        n = new.functions.get(name, 0)
+        increase = 100.0 * (n / nt - b / bt) if bt and nt else 0
+        if increase > maxShareIncrease:
+            p = increasePValue(b, bt, n, nt)
+            if p < alpha:
+                regressions.append({"name": name, "base": 100.0 * b / bt, "new": 100.0 * n / nt, "p": p})
+    busyIncrease = 100.0 * (new.busy() - base.busy())
+    if busyIncrease > maxBusyIncrease:
+        p = increasePValue(bt - base.idleSamples(), bt, nt - new.idleSamples(), nt)
+        if p < alpha:
+            regressions.append({"name": "<busy>", "base": 100.0 * base.busy(), "new": 100.0 * new.busy(), "p": p})
+    return sorted(regressions, key=lambda r: r["new"] - r["base"], reverse=True)
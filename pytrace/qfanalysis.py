@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+  Analysis of the QP/QF active object records the firmware sends on the
+  DBG_EV_PORT_QF* ITM ports:
+
+    port 9  (QFSIGDISPATCH)  AO index (byte 3) + signal (bytes 0..2) at start of dispatch
+    port 10 (QFSIGCOMPLETE)  AO index (byte 3) + signal (bytes 0..2) at end of run to completion
+    port 11 (QFSTATEENTRY)   address of the state handler entered
+
+  Each record is preceded by a 1 byte timestamp on the same port.  Dispatch
+  and completion are paired per AO to give run-to-completion (RTC) times; a
+  state entry belongs to the AO whose RTC step is running, the innermost
+  one if a higher priority AO has pre-empted.
+
+  The 1 byte timestamps wrap every 256 ticks (12.8ms at 50us), so unless a
+  16 bit timer update (port 8) falls inside it an RTC step is only measured
+  modulo 12.8ms.  Where the host receive times of the two records show whole
+  wraps were missed they are added back, but steps whose records arrive in
+  the same read can still be under-reported.
+"""
+
+import json
+from collections import deque
+
+# caps on distinct keys, so corrupted records on a noisy line can't grow the
+# tables without limit over a long capture; the overflow goes in OTHER
+MAX_AOS = 64
+MAX_SIGNALS = 128
+MAX_STATES = 1024
+OTHER = -1
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of a list of numbers."""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+class RTCStats(object):
+    """Run-to-completion durations (in us) for one AO or signal.  Count, mean
+    and max cover every step, percentiles the most recent maxSamples."""
+
+    def __init__(self, maxSamples=10000):
+        self.dispatches = 0
+        self.completed = 0
+        self.total_us = 0
+        self.max_us = 0
+        self.durations = deque(maxlen=maxSamples)
+
+    def add(self, duration_us):
+        self.completed += 1
+        self.total_us += duration_us
+        self.max_us = max(self.max_us, duration_us)
+        self.durations.append(duration_us)
+
+    def summary(self):
+        d = self.durations
+        return {"dispatches": self.dispatches,
+                "completed": self.completed,
+                "mean_us": self.total_us / self.completed if self.completed else 0,
+                "p50_us": percentile(d, 50),
+                "p99_us": percentile(d, 99),
+                "max_us": self.max_us}
+
+
+class QFAnalyser(object):
+    """Pairs QF dispatch/complete records per active object and gathers
+    RTC, dispatch rate and state residency statistics.  Times are target
+    timer ticks of tick_us microseconds."""
+
+    def __init__(self, addr2sym=None, tick_us=50, keepTimeline=False, wrapTicks=256):
+        self.addr2sym = addr2sym
+        self.tick_us = tick_us
+        self.wrapTicks = wrapTicks
+        self.keepTimeline = keepTimeline
+        self.timeline = []
+        self.perAO = {}
+        self.perSignal = {}
+        self.unpaired = 0
+        self.wrapped = 0      # RTC steps longer than the timestamp wrap, corrected from host time
+        self._open = {}       # ao -> (start ticks, sig, start host time)
+        self._running = []    # stack of AOs mid RTC step, innermost last
+        self._state = {}      # ao -> (state addr, entry ticks)
+        self._residency = {}  # (ao, state addr) -> ticks
+        self._first = None
+        self._last = None
+
+    @staticmethod
+    def _bucket(table, key, limit):
+        return key if key in table or len(table) < limit else OTHER
+
+    def _seen(self, ticks):
+        if self._first is None:
+            self._first = ticks
+        self._last = ticks
+
+    def stateName(self, addr):
+        if addr == OTHER:
+            return "other"
+        name = None
+        if self.addr2sym:
+            # state handlers are thumb function pointers, symbol table has them even
+            name = self.addr2sym.addr2name(addr) or self.addr2sym.addr2name(addr & ~1)
+        return name or "{:08x}".format(addr)
+
+    def onDispatch(self, ticks, ao, sig, hostTime=None):
+        self._seen(ticks)
+        ao = self._bucket(self.perAO, ao, MAX_AOS)
+        sig = self._bucket(self.perSignal, sig, MAX_SIGNALS)
+        if ao in self._open:
+            # lost the completion record
+            self.unpaired += 1
+            self._running.remove(ao)
+        self._open[ao] = (ticks, sig, hostTime)
+        self._running.append(ao)
+        self.perAO.setdefault(ao, RTCStats()).dispatches += 1
+        self.perSignal.setdefault(sig, RTCStats()).dispatches += 1
+
+    def onComplete(self, ticks, ao, sig, hostTime=None):
+        self._seen(ticks)
+        ao = self._bucket(self.perAO, ao, MAX_AOS)
+        if ao not in self._open:
+            self.unpaired += 1
+            return
+        start, dispatchedSig, startHost = self._open.pop(ao)
+        self._running.remove(ao)
+        duration = ticks - start
+        if hostTime is not None and startHost is not None:
+            # nearest whole number of timestamp wraps the host saw that the ticks did not
+            wrap_s = self.wrapTicks * self.tick_us / 1000000.0
+            missed = round((hostTime - startHost - duration * self.tick_us / 1000000.0) / wrap_s)
+            if missed > 0:
+                duration += missed * self.wrapTicks
+                self.wrapped += 1
+        duration_us = duration * self.tick_us
+        self.perAO[ao].add(duration_us)
+        self.perSignal[dispatchedSig].add(duration_us)
+        if self.keepTimeline:
+            self.timeline.append({"name": "sig " + self._label(dispatchedSig, 4), "cat": "rtc", "ph": "X",
+                                  "ts": start * self.tick_us, "dur": duration_us, "pid": 0, "tid": ao,
+                                  "args": {"sig": dispatchedSig}})
+
+    def onStateEntry(self, ticks, addr):
+        self._seen(ticks)
+        if not self._running:
+            return
+        ao = self._running[-1]
+        if (ao, addr) not in self._residency and len(self._residency) >= MAX_STATES:
+            addr = OTHER
+        prev = self._state.get(ao)
+        if prev:
+            key = (ao, prev[0])
+            self._residency[key] = self._residency.get(key, 0) + ticks - prev[1]
+        self._state[ao] = (addr, ticks)
+        if self.keepTimeline:
+            self.timeline.append({"name": self.stateName(addr), "cat": "state", "ph": "i", "s": "t",
+                                  "ts": ticks * self.tick_us, "pid": 0, "tid": ao})
+
+    def span_s(self):
+        if self._first is None:
+            return 0
+        return (self._last - self._first) * self.tick_us / 1000000.0
+
+    def residency(self):
+        """Time in us each AO has spent in each state, including the state it is in now."""
+        res = dict(self._residency)
+        for ao, (addr, entered) in self._state.items():
+            res[(ao, addr)] = res.get((ao, addr), 0) + self._last - entered
+        return {(ao, self.stateName(addr)): ticks * self.tick_us for (ao, addr), ticks in res.items()}
+
+    def formatReport(self):
+        span = self.span_s()
+        lines = ["QF over {:.3f}s, {} unpaired records".format(span, self.unpaired)]
+        lines.append("  {} RTC steps over {:.1f}ms corrected from host receive time (steps received in one read"
+                     " are measured modulo {:.1f}ms, unless a 16 bit timer update falls inside)".format(
+                         self.wrapped, self.wrapTicks * self.tick_us / 1000.0, self.wrapTicks * self.tick_us / 1000.0))
+        lines.append("  {:>6} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            "AO", "disp", "rate/s", "mean us", "p50 us", "p99 us", "max us"))
+        for ao in sorted(self.perAO):
+            lines.append(self._formatRow(self._label(ao, 2), self.perAO[ao].summary(), span))
+        lines.append("  {:>6} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            "SIG", "disp", "rate/s", "mean us", "p50 us", "p99 us", "max us"))
+        for sig in sorted(self.perSignal):
+            lines.append(self._formatRow(self._label(sig, 4), self.perSignal[sig].summary(), span))
+        lines.append("  state residency:")
+        for (ao, name), us in sorted(self.residency().items()):
+            lines.append("  {:>6} {:>12}us  {}".format(self._label(ao, 2), us, name))
+        return "\n".join(lines)
+
+    @staticmethod
+    def _label(key, digits):
+        return "other" if key == OTHER else "{:0{}x}".format(key, digits)
+
+    def _formatRow(self, label, s, span):
+        rate = s["dispatches"] / span if span else 0
+        return "  {:>6} {:>9} {:>9.1f} {:>9.0f} {:>9} {:>9} {:>9}".format(
+            label, s["dispatches"], rate, s["mean_us"], s["p50_us"], s["p99_us"], s["max_us"])
+
+    def exportTrace(self, path):
+        """Write the timeline as Chrome trace-event JSON (loads in chrome://tracing and Perfetto)."""
+        events = [{"name": "thread_name", "ph": "M", "pid": 0, "tid": ao, "args": {"name": "AO " + self._label(ao, 2)}}
+                  for ao in sorted(self.perAO)]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events + self.timeline, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+  Support for long (multi-day) soak captures: compressed rotating output
+  files, periodic statistics snapshots and process memory reporting, so a
+  capture can run unattended with flat memory and bounded disk use.
+"""
+
+import datetime
+import glob
+import gzip
+import json
+import os
+import sys
+import time
+from array import array
+
+# a snapshot line is ~1-2kB, so at one a minute this is months of history
+SNAPSHOT_FILE_BYTES = 10 * 1000 * 1000
+SNAPSHOT_KEEP = 100
+
+
+def rssBytes():
+    """Resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        # peak, not current, but the best we get without /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RotatingOutput(object):
+    """File like object writing gzip compressed text files named
+    <basePath>-<date>-<time>-<seq>.gz.  A new file is started once maxBytes
+    (uncompressed) have been written or the file is maxAge seconds old, and
+    only the newest keep files are kept."""
+
+    def __init__(self, basePath, maxBytes=100 * 1000 * 1000, maxAge=None, keep=20):
+        self.basePath = basePath
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.keep = keep
+        self._f = None
+        self._written = 0
+        self._opened = 0
+        self._seq = 0
+        dirName = os.path.dirname(basePath)
+        if dirName:
+            os.makedirs(dirName, exist_ok=True)
+
+    def write(self, text):
+        if self._f is None or self._due():
+            self._rotate()
+        self._f.write(text)
+        self._written += len(text)
+        return len(text)
+
+    def flush(self):
+        if self._f:
+            self._f.flush()
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+
+    def _due(self):
+        if self.maxBytes and self._written >= self.maxBytes:
+            return True
+        return bool(self.maxAge) and time.monotonic() - self._opened >= self.maxAge
+
+    def _rotate(self):
+        self.close()
+        self._seq += 1
+        name = "{}-{}-{:06}.gz".format(self.basePath, time.strftime("%Y%m%d-%H%M%S"), self._seq)
+        self._f = gzip.open(name, "wt")
+        self._written = 0
+        self._opened = time.monotonic()
+        files = sorted(glob.glob(glob.escape(self.basePath) + "-*.gz"))
+        for old in files[:-self.keep]:
+            os.remove(old)
+
+
+class SoakMonitor(object):
+    """Writes a JSON snapshot line every interval seconds: stream health,
+    dropped stlink reads, the PC samples per function (and sleeping) for the
+    interval and the process RSS.  A one line summary also goes to stderr so
+    the rig shows it is alive."""
+
+    def __init__(self, parser, trace, out, interval=60, top=20):
+        self.parser = parser
+        self.trace = trace
+        self.out = out
+        self.interval = interval
+        self.top = top
+        self._start = time.monotonic()
+        self._next = self._start + interval
+        self._prevCounts = array('Q', parser.funcHist.counts)
+        self._prevSleeps = parser.sleeps
+
+    def poll(self):
+        if time.monotonic() >= self._next:
+            self.snapshot()
+
+    def snapshot(self):
+        now = time.monotonic()
+        self._next = now + self.interval
+        counts = self.parser.funcHist.counts
+        delta = array('Q', (n - p for n, p in zip(counts, self._prevCounts)))
+        self._prevCounts = array('Q', counts)
+        sleeps = self.parser.sleeps - self._prevSleeps
+        self._prevSleeps = self.parser.sleeps
+        gprof = sorted(self.parser.funcHist.toDict(delta).items(), key=lambda kv: kv[1], reverse=True)
+        rec = {"time": datetime.datetime.now().isoformat(timespec="seconds"),
+               "uptime_s": round(now - self._start),
+               "rss_bytes": rssBytes(),
+               "stream": self.parser.getStats(),
+               "droppedReads": self.trace.droppedReads,
+               "sleeps": sleeps,
+               "gprof": dict(gprof[:self.top])}
+        self.out.write(json.dumps(rec) + "\n")
+        self.out.flush()
+        print("{} up {}s rss {:.1f}MB dropped reads {} discarded bytes {}".format(
+            rec["time"], rec["uptime_s"], rec["rss_bytes"] / 1e6, rec["droppedReads"],
+            rec["stream"]["discardedBytes"]), file=sys.stderr)
@@ -9,18 +9,26 @@ import math
 import time
 import queue, threading
 import copy
+from collections import deque
+from pytrace.tpiuparser import Marker
 
 class StlinkTrace():
     """ST-Link SWO tracing class.
     This knows how to manage the arm Cortex-M ITM and TPIU via
-    an ST-Link usb JTAG dongle as accessed by pyswd class (provided by pyswd module)."""
+    an ST-Link usb JTAG dongle as accessed by pyswd class (provided by pyswd module).
 
-    def __init__(self, xtal_MHz=72, swo_baud=250000):
+    While SWO is active the pump thread owns the probe; setWatch, setExceptionTracing
+    and setProfiling are then queued to it, applied between read_swo polls, and
+    confirmed by a Marker in the readSWO data at the point they took effect."""
+
+    def __init__(self, xtal_MHz=72, swo_baud=250000, max_queue=1000):
         self._stlink = stlink.Stlink()
         s = self._stlink.version.str
         self._xtal_MHz = xtal_MHz
         self._swo_baud = swo_baud
-        self._DWT_CTRL_SHADOW = 0
+        # SYNCTAP=01, CYCCNTENA: periodic ITM sync packets every 2**24 cycles,
+        # so dumps can be split for parallel decoding (pytrace decode)
+        self._DWT_CTRL_SHADOW = 0x00000401
         self._exception_tracing = False
         self._profiling = False
         # we remember all DWT settings for auto resetting after power cycles
@@ -36,8 +44,16 @@ class StlinkTrace():
         self._setProfiling()
         self._readingSWO = False
         self._readingSWO = False
-        self._queue = queue.Queue()
-        self._thread = threading.Thread(target=self._pumpSWO)
+        # bounded in SWO reads, if the reader falls behind the oldest reads are
+        # dropped.  Markers are never dropped (nor counted), there are only a few
+        self._queue = deque()
+        self._queued = threading.Condition()
+        self._maxReads = max_queue
+        self._queuedReads = 0
+        self.droppedReads = 0
+        self._commands = queue.Queue()
+        self._voltage = None
+        self._thread = None
 
     def _pumpSWO(self):
         """Thread function for pumping libUSB link to read
@@ -47,7 +63,9 @@ class StlinkTrace():
         self._stlink.stop_trace_rx()
         self._stlink.start_trace_rx(baud_rate_hz=self._swo_baud)
         while self._readingSWO:
+            self._applyCommands()
             v = self._stlink.get_target_voltage()
+            self._voltage = v
             if v < 1:
                 #print("powered OFF! - waiting for power up")
                 while self._stlink.get_target_voltage() < 3:
@@ -77,27 +95,87 @@ class StlinkTrace():
                         self._stlink.start_trace_rx(baud_rate_hz=self._swo_baud)
                         zeroCnt = 0
                 elif ( num > 0 ):
-                    self._queue.put(self._stlink.com.read_swo())
+                    data = self._stlink.com.read_swo()
+                    self._enqueue(data, time.monotonic())
         self._stlink.stop_trace_rx()
+        self._applyCommands()
+
+    def _submit(self, marker, apply):
+        """apply a probe change now, or if SWO is active hand it to the pump thread.
+        Returns the marker that will confirm it."""
+        if self._readingSWO:
+            self._commands.put((marker, apply))
+        else:
+            apply()
+        return marker
+
+    def _applyCommands(self):
+        """pump thread (or stopped) side of _submit."""
+        while True:
+            try:
+                marker, apply = self._commands.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                apply()
+            except Exception as e:
+                marker.error = str(e)
+            self._enqueue(marker, time.monotonic())
+
+    def _enqueue(self, data, hostTime):
+        """queue data, received at hostTime, for readSWO, never blocking the pump thread."""
+        with self._queued:
+            if not isinstance(data, Marker):
+                if self._queuedReads >= self._maxReads:
+                    # drop the oldest read, step over any markers ahead of it
+                    for i, (old, t) in enumerate(self._queue):
+                        if not isinstance(old, Marker):
+                            del self._queue[i]
+                            break
+                    self._queuedReads -= 1
+                    self.droppedReads += 1
+                self._queuedReads += 1
+            self._queue.append((data, hostTime))
+            self._queued.notify()
 
     def startSWO(self):
         self._readingSWO = True
+        self._thread = threading.Thread(target=self._pumpSWO)
         self._thread.start()
 
-    def stopSWO(self):
+    def stopSWO(self, timeout=2):
+        """stop the pump thread, waiting up to timeout seconds for it to finish so
+        SWO can be restarted (e.g. to reconfigure tracing)."""
         self._readingSWO = False # will cause thread function to finish
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        if not (self._thread and self._thread.is_alive()):
+            # anything queued after the pump's last poll.  If it is still running
+            # (stuck in a read) it owns the probe, and applies them on its way out
+            self._applyCommands()
         
     def readSWO(self):
-        try:
-            data = self._queue.get(timeout=1)
-        except queue.Empty:
-            data = None
-        return data
+        """next buffer of SWO bytes, a Marker for an applied reconfiguration, or None after 1s."""
+        return self.readSWOTimed()[0]
+
+    def readSWOTimed(self):
+        """as readSWO, but returns (data, hostTime) where hostTime is the time.monotonic()
+        the pump thread received it, for TPIUParser.parseBytes.  (None, None) after 1s."""
+        with self._queued:
+            if not self._queued.wait_for(lambda: self._queue, timeout=1):
+                return None, None
+            data, hostTime = self._queue.popleft()
+            if not isinstance(data, Marker):
+                self._queuedReads -= 1
+            return data, hostTime
 
     def getCoreID(self):
         return self._stlink.get_coreid()
 
     def getTargetVoltage(self):
+        if self._readingSWO:
+            # pump thread polls it every loop
+            return self._voltage
         return self._stlink.get_target_voltage()
 
     def _setAllWatches(self):
@@ -162,29 +240,36 @@ class StlinkTrace():
         else:
             # disable bit12, PCSAMPLEENA
             self._clearDWTCTRLShadowBits(0x00001000)
-            # disable bit0, CYCCNTENA
-            self._clearDWTCTRLShadowBits(0x00000001)
+            # leave bit0, CYCCNTENA, on, the periodic sync packets need it
         self._applyDWTCTRLRegisterShadow()
 
     def setExceptionTracing(self, enable_tracing):
-        self._exception_tracing = enable_tracing
-        self._setExceptionTracing()
+        def apply():
+            self._exception_tracing = enable_tracing
+            self._setExceptionTracing()
+        return self._submit(Marker("setExceptionTracing", {"enable": enable_tracing}), apply)
 
     def setProfiling(self, enable_profiling):
-        self._profiling = enable_profiling
-        self._setProfiling()
+        def apply():
+            self._profiling = enable_profiling
+            self._setProfiling()
+        return self._submit(Marker("setProfiling", {"enable": enable_profiling}), apply)
 
-    def setWatch(self, index, addr, size = 4, getData = True, getPC = False, getOffset = False):
+    def setWatch(self, index, addr, size = 4, getData = True, getPC = False, getOffset = False, tag = None):
         """ set the DWT(index) to watch data access of address.  can get SWO output for
         the data (read and write), the PC for the instruction that accessed the addr, and the
         offset into the address block (address:size).  Note if requesting PC and offset you only
-        get the offset due to limitations of the DWT. """
-        self._DWT[index]['addr']      = addr
-        self._DWT[index]['size']      = size
-        self._DWT[index]['getPC']     = getPC
-        self._DWT[index]['getData']   = getData
-        self._DWT[index]['getOffset'] = getOffset
-        self._setWatch(index)
+        get the offset due to limitations of the DWT.  tag is passed back on the confirming
+        Marker, e.g. for the parser to relabel the DWT. """
+        def apply():
+            self._DWT[index]['addr']      = addr
+            self._DWT[index]['size']      = size
+            self._DWT[index]['getPC']     = getPC
+            self._DWT[index]['getData']   = getData
+            self._DWT[index]['getOffset'] = getOffset
+            self._setWatch(index)
+        args = {"index": index, "addr": addr, "size": size, "getData": getData, "getPC": getPC, "getOffset": getOffset}
+        return self._submit(Marker("setWatch", args, tag), apply)
 
     def _setupSWOTracing(self, xtal_MHz, baud):
         # captured via tshark from openocd with tpiu config
@@ -201,7 +286,7 @@ class StlinkTrace():
         self._stlink.set_mem32(0xe0001000, self._DWT_CTRL_SHADOW)
 
         self._stlink.set_mem32(0xe0000fb0, 0xc5acce55)
-        self._stlink.set_mem32(0xe0000e80, 0x00010009)
+        self._stlink.set_mem32(0xe0000e80, 0x0001000d)  # ITM_TCR: ITMENA, SYNCENA, TXENA, TraceBusID 1
         self._stlink.set_mem32(0xe0000e00, 0xffffffff)
         self._stlink.set_mem32(0xe0000e04, 0x00000000)
         self._stlink.set_mem32(0xe0000e08, 0x00000000)
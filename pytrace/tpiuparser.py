@@ -10,6 +10,11 @@
 
 from subprocess import Popen, PIPE, run
 from enum import Enum
+from array import array
+import bisect
+import re
+import time
+from pytrace.qfanalysis import QFAnalyser
 
 DBG_EV_PORT_TIMESTAMP        = 8
 DBG_EV_PORT_QFSIGDISPATCH    = 9
@@ -17,6 +22,13 @@ DBG_EV_PORT_QFSIGCOMPLETE    = 10
 DBG_EV_PORT_QFSTATEENTRY     = 11
 DBG_EV_PORT_FIRST_USER_EVENT = 20
 
+# ITM synchronisation packet; at least 47 zero bits then a one bit, which on
+# a byte aligned SWO stream is five (or more) 0x00 bytes followed by 0x80.
+SYNC_PACKET = b'\x00\x00\x00\x00\x00\x80'
+# how far to look for a sync packet after losing sync before falling back to
+# scanning for a plausible header; periodic sync is not enabled by this tool, so
+# one sync packet (or a power glitch that looked like one) is no promise of more.
+SYNC_WAIT_BYTES = 64
 
 
 class Address2LineResolver(object):
@@ -100,6 +112,55 @@ class Address2SymbolResolver(object):
     def addr2sym(self, addr):
         return self._addr2sym.get(addr, None)
 
+    def functions(self):
+        """ (addr, size, name) of every code symbol, sorted by address. """
+        return sorted((addr, rec['size'], rec['sym']) for addr, rec in self._addr2sym.items()
+                      if rec['section'] in "tTwW")
+
+class FunctionHistogram(object):
+    """Fixed size histogram of PC samples by function.  Functions are integer IDs
+    (index into the symbol table sorted by address) so counting a sample is a
+    bisect and an array increment, and memory does not grow with run time.
+    PCs outside every function land in the last bin."""
+
+    UNKNOWN = "??"
+
+    def __init__(self, addr2sym):
+        funcs = addr2sym.functions()
+        self._starts = [f[0] for f in funcs]
+        self._ends = []
+        for i, (addr, size, name) in enumerate(funcs):
+            if size:
+                self._ends.append(addr + size)
+            else:
+                # no size in the map, assume it runs to the next symbol
+                self._ends.append(funcs[i+1][0] if i+1 < len(funcs) else addr + 1)
+        self._names = [f[2] for f in funcs] + [self.UNKNOWN]
+        self.counts = array('Q', [0] * len(self._names))
+
+    def index(self, pc):
+        i = bisect.bisect_right(self._starts, pc) - 1
+        if i >= 0 and pc < self._ends[i]:
+            return i
+        return len(self._names) - 1
+
+    def add(self, pc):
+        i = self.index(pc)
+        self.counts[i] += 1
+        return i
+
+    def name(self, index):
+        return self._names[index]
+
+    def toDict(self, counts=None):
+        """ {function name: samples} for the functions that have any. """
+        counts = counts if counts is not None else self.counts
+        hist = {}
+        for i, n in enumerate(counts):
+            if n:
+                hist[self._names[i]] = hist.get(self._names[i], 0) + n
+        return hist
+
 class State:
     def onEntry(self, me):
         pass
@@ -137,13 +198,34 @@ class StateMachine:
             print("Event! {}, data[{}]".format(event, data))
 
 
-class TPIUParserSM(StateMachine):
-    def __init__(self):
-        StateMachine.__init__(self, _WaitingForHeader())
 
-class SITData:
+class Stamp:
+    """ time stamp carried by every decoded event, events with no data get a bare one.
+        ticks: target timeline (TimeBase.ticks) as of the event, None if no timebase
+        hostTime: host monotonic time the bytes were received """
+    def __init__(self):
+        self.ticks = None
+        self.hostTime = None
+
+class Marker(Stamp):
+    """ event confirming a probe reconfiguration took effect at this point in the stream.
+        command: name of the StlinkTrace call, args: its arguments, tag: caller's data,
+        error: text if applying it failed """
+    def __init__(self, command, args, tag=None):
+        Stamp.__init__(self)
+        self.command = command
+        self.args = args
+        self.tag = tag
+        self.error = None
+
+    def __str__(self):
+        args = " ".join("{}={}".format(k, hex(v) if k == "addr" and v else v) for k, v in self.args.items())
+        return "{} {}{}".format(self.command, args, " FAILED: {}".format(self.error) if self.error else "")
+
+class SITData(Stamp):
     """ data class for Software Instrumentation data """
     def __init__(self, chan, lth):
+        Stamp.__init__(self)
         self.chan = chan
         self.expectedLth = lth
         self.lth = 0
@@ -164,9 +246,10 @@ class Type(Enum):
     DATA_TRACE_OFFSET = 4
     DATA_TRACE_DATA   = 5
 
-class HSPData:
+class HSPData(Stamp):
     """ data class for Hardware Source Packet data """
     def __init__(self, discriminator, lth):
+        Stamp.__init__(self)
         self.discriminator = discriminator
         if discriminator == 0:
             self.type = Type.EVENT_COUNT
@@ -200,23 +283,178 @@ class HSPData:
         self.lth += 1
         self.data.append(byte)
 
+    def isPlausible(self):
+        """ sanity check a complete packet, a header made from line noise
+        usually gives a payload the DWT could never have produced. """
+        if self.type == Type.EXCEPTION_TRACE:
+            # function 0 is reserved
+            return (self.data[1] & 0x30) != 0
+        elif self.type in (Type.PC_SAMPLE, Type.DATA_TRACE_PC):
+            # thumb code, PC is always halfword aligned
+            return (self.value & 0x01) == 0
+        return True
+
+
+def _isValidHeader(byte):
+    """ True if byte can start a packet this decoder expects to see. """
+    if byte == 0x00 or byte == 0x70:
+        # start of sync packet, or overflow
+        return True
+    size = byte & 0x03
+    if size == 0:
+        # lone 0x80, local/global timestamps and extension packets are not enabled
+        return False
+    if (byte & 0x04) == 0x00:
+        # software source (ITM stimulus port), any port any size
+        return True
+    lth = (2 ** (2+size)) >> 3
+    disc = (0xf8 & byte) >> 3
+    if disc == 0:
+        return lth == 1                  # event counter
+    elif disc == 1:
+        return lth == 2                  # exception trace
+    elif disc == 2:
+        return lth in (1, 4)             # PC sample, or 1 byte sleep packet
+    elif 8 <= disc <= 15:
+        return lth == (2 if disc & 0x01 else 4)  # data trace address offset / PC
+    elif 16 <= disc <= 23:
+        return True                      # data trace value, 1, 2 or 4 bytes
+    return False
+
+
+_VALID_HEADER = [_isValidHeader(b) for b in range(256)]
+_HEADER_SEARCH = re.compile(b'[' + b''.join(re.escape(bytes([b])) for b in range(256) if _VALID_HEADER[b]) + b']')
+
+class TPIUParserSM(StateMachine):
+    """ State machine for the ITM packet stream, with sync tracking.
+
+    When a byte turns up that can not be a packet header, or a completed packet
+    is implausible, the stream is flagged out of sync and parseBytes() scans
+    ahead for the next sync packet rather than decoding the garbage.  If none
+    turns up within SYNC_WAIT_BYTES (or the target has never sent one) it
+    resyncs on the next plausible header instead. """
+    def __init__(self):
+        self.inSync = True
+        self.syncSeen = False     # target sends sync packets, so resync to them
+        self.zeroRun = 0          # 0x00 bytes seen in header position (partial sync packet)
+        self.syncs = 0
+        self.resyncs = 0
+        self.discardedBytes = 0
+        self.falsePackets = 0
+        self._carry = b''         # trailing zeros of a possible sync split across buffers
+        self._waited = 0          # bytes searched for a sync packet since losing sync
+        self.timebase = None      # TimeBase to stamp events with
+        StateMachine.__init__(self, _WaitingForHeader())
+
+    def onEvent(self, event, data = None):
+        if self.timebase:
+            if data is None:
+                data = Stamp()
+            data.ticks = self.timebase.ticks
+            data.hostTime = self.timebase.hostTime
+        StateMachine.onEvent(self, event, data)
+
+    def parseBytes(self, buf):
+        if isinstance(buf, Marker):
+            # reconfiguration confirmed in the byte stream, not bytes
+            self.onEvent("Marker", buf)
+            return
+        if not isinstance(buf, (bytes, bytearray)):
+            # e.g. a list of ints, the resync search needs a bytes-like buffer
+            buf = bytes(buf)
+        i = 0
+        n = len(buf)
+        while i < n:
+            if self.inSync:
+                self.currState.onRxByte(self, buf[i])
+                i += 1
+            else:
+                i = self._resync(buf, i)
+
+    def onSync(self):
+        self.syncs += 1
+        self.syncSeen = True
+        self.inSync = True
+        self.onEvent("Sync")
+
+    def loseSync(self, discarded=1):
+        """ throw away the current packet (of discarded bytes) and rescan for a sync point. """
+        self.discardedBytes += discarded
+        self.zeroRun = 0
+        if self.inSync:
+            self.inSync = False
+            self.resyncs += 1
+            self._waited = 0
+            self.onEvent("SyncLost")
+        self.trans(_WaitingForHeader())
+
+    def dropZeros(self):
+        """ a run of 0x00 headers that never became a sync packet, throw the zeros away. """
+        self.discardedBytes += self.zeroRun
+        self.zeroRun = 0
+
+    def getStats(self):
+        return {"syncs": self.syncs,
+                "resyncs": self.resyncs,
+                "discardedBytes": self.discardedBytes,
+                "falsePackets": self.falsePackets}
+
+    def _resync(self, buf, i):
+        """ skip buf from index i to the next sync point, returns the index to carry on parsing from. """
+        if self.syncSeen and self._waited < SYNC_WAIT_BYTES:
+            limit = min(len(buf), i + SYNC_WAIT_BYTES - self._waited)
+            carried = len(self._carry)
+            data = self._carry + bytes(buf[i:limit])
+            idx = data.find(SYNC_PACKET)
+            if idx < 0:
+                # keep any trailing zeros, they may be the start of a sync packet
+                keep = min(len(data) - len(data.rstrip(b'\x00')), len(SYNC_PACKET) - 1)
+                self.discardedBytes += len(data) - keep
+                self._carry = data[len(data) - keep:]
+                self._waited += limit - i
+                return limit
+            self.discardedBytes += idx
+            self._carry = b''
+            self.onSync()
+            return i + idx + len(SYNC_PACKET) - carried
+        # no sync packet coming, zeros held back for one are garbage too
+        self.discardedBytes += len(self._carry)
+        self._carry = b''
+        m = _HEADER_SEARCH.search(buf, i)
+        if m is None:
+            self.discardedBytes += len(buf) - i
+            return len(buf)
+        self.discardedBytes += m.start() - i
+        self.inSync = True
+        return m.start()
+
 class _WaitingForHeader(State):
     def onRxByte(self, me, byte):
         #print "WAITING HEADER got byte 0x{:02x}".format(bffyte)
-        if byte == 0x70:
+        if me.zeroRun:
+            if byte == 0x00:
+                me.zeroRun += 1
+            elif byte == 0x80 and me.zeroRun >= 5:
+                me.zeroRun = 0
+                me.onSync()
+            else:
+                # zeros that never became a sync packet, byte may still be a good header
+                me.dropZeros()
+                self.onRxByte(me, byte)
+        elif not _VALID_HEADER[byte]:
+            me.loseSync()
+        elif byte == 0x00:
+            me.zeroRun = 1
+        elif byte == 0x70:
             me.onEvent("Overflow")
-        elif (byte & 0x7f) == 0x00:
-            me.onEvent("Sync byte")
-        elif ((byte & 0x03) != 0x00) and ((byte & 0x04) == 0x04):
+        elif (byte & 0x04) == 0x04:
             size = (2 ** (2+(byte & 0x03))) >> 3
             disc = (0xf8 & byte) >> 3
             me.trans(_HardwareBody(disc, size))
-        elif ((byte & 0x03) != 0x00) and ((byte & 0x04) == 0x00):
+        else:
             size = (2 ** (2+(byte & 0x03))) >> 3
             chan = (0xf8 & byte) >> 3
             me.trans(_SoftwareBody(chan, size))
-        else:
-            me.onEvent("DUFFBYTE", "{:02x}".format(byte))
             
 class _SoftwareBody(State):
     def __init__(self, channel, payloadLth):
@@ -239,44 +477,101 @@ class _HardwareBody(State):
         self.hsp.addByte(byte)
         self.len -= 1
         if self.len == 0:
+            if not self.hsp.isPlausible():
+                me.falsePackets += 1
+                me.loseSync(1 + self.hsp.lth)
+                return
             me.onEvent("HSP_"+self.hsp.type.name, self.hsp)
             me.trans(_WaitingForHeader())
 
-class TimeStamp(object):
-    """ manages timebase from updates via SWO of
-        the 50us TREF timer. """
-    def __init__(self):
-        self.time_50us = 0  # continuously incrementing value
+class TimeBase(object):
+    """ 64 bit target timeline built from the 8 and 16 bit fragments of the
+        50us TREF timer the target sends via SWO, fused with host receive time.
+
+        Each fragment only gives the timer modulo 2**bits, so the tick count is
+        extended by the modulo difference from the last update.  For fragments
+        whose period is well over the host receive jitter (16 bits and wider)
+        the nearest number of whole wraps the host clock says were missed (e.g.
+        lost packets or a quiet target) is added too; if the host time falls
+        too close to between two wrap counts to tell, it is counted as a gap.
+        8 bit fragments wrap faster than the host can resolve, they are taken
+        as the modulo difference only. """
+    HOST_JITTER_S = 0.05   # USB buffering between the target sending and us receiving
+
+    def __init__(self, tick_us=50):
+        self.tick_us = tick_us
+        self.ticks = 0         # continuously incrementing target time, in ticks
         self.lastDiff = 0
-        self._time_s = 0
+        self.hostTime = None   # host receive time of the bytes being decoded
+        self.synced = False    # had a full 16 bit update
+        self.gaps = 0
+        self._anchor = None    # (ticks, hostTime) of first full update, for drift
+        self._lastFull = None  # (ticks, hostTime) of latest full update, for drift
+        self._lastHost = None  # hostTime at last update
+
+    def setHostTime(self, t):
+        self.hostTime = t
 
     def update8(self, u8):
         """ increment timestamp using the 8bit modulo
         (LSB) of the 50us timer on the target. """
-        self.lastDiff = (u8 - (self.time_50us & 0xff)) % 0x100
-        # print "update8 {} {}".format(self.lastDiff, self.time_50us)
-        self.time_50us += self.lastDiff
+        self.update(u8, 8)
 
     def update16(self, u16):
-        """ increment timestamp using the 8bit modulo
-        (LSB) of the 50us timer on the target. """
-        self._time_s += 0.01  # hack to count timer update msgs, as modulo addition not working
-        self.lastDiff = (u16 - (self.time_50us & 0xffff)) % 0x10000
-        self.time_50us += self.lastDiff
-        if (self.time_50us == self.lastDiff):
-            self.lastDiff = 0  # first update of full timer.
+        """ increment timestamp using the 16bit modulo
+        of the 50us timer on the target. """
+        self.update(u16, 16)
+
+    def update(self, fragment, bits):
+        mod = 1 << bits
+        diff = (fragment - self.ticks) % mod
+        period_s = mod * self.tick_us / 1000000.0
+        if (self.synced and period_s > 2 * self.HOST_JITTER_S
+                and self.hostTime is not None and self._lastHost is not None):
+            # nearest whole number of wraps to the host elapsed time
+            wraps = (self.hostTime - self._lastHost - diff * self.tick_us / 1000000.0) / period_s
+            missed = max(0, round(wraps))
+            if abs(wraps - missed) > 0.5 - self.HOST_JITTER_S / period_s:
+                # within jitter of the next wrap count either way, can't tell which
+                self.gaps += 1
+            diff += missed * mod
+        self.ticks += diff
+        self.lastDiff = diff
+        self._lastHost = self.hostTime
+        if bits >= 16:
+            if not self.synced:
+                # first update of full timer.
+                self.synced = True
+                self.lastDiff = 0
+                if self.hostTime is not None:
+                    self._anchor = (self.ticks, self.hostTime)
+            if self.hostTime is not None:
+                self._lastFull = (self.ticks, self.hostTime)
+
+    def driftPpm(self):
+        """ how much faster (+ve) the target timer runs than the host clock, 0 until there
+        is enough of a timeline to tell. """
+        if self._anchor is None or self._lastFull is None:
+            return 0
+        # full updates only, the 8 bit ones in between may have missed wraps
+        host_s = self._lastFull[1] - self._anchor[1]
+        if host_s < 10 * self.HOST_JITTER_S:
+            return 0
+        target_s = (self._lastFull[0] - self._anchor[0]) * self.tick_us / 1000000.0
+        return (target_s - host_s) / host_s * 1000000
+
+    def us(self):
+        return self.ticks * self.tick_us
 
     def fmtNull(self):
         return "[---.------]"
 
     def fmtAbs(self):
-        time_us = self.time_50us * 50
-        return "[{:07.2f}]".format(self._time_s)
-        #return "[{:03}.{:06}]".format(time_us/1000000, time_us%1000000)
-        #return "[{}]".format(time_us/1000000)
+        time_us = self.us()
+        return "[{:03}.{:06}]".format(time_us // 1000000, time_us % 1000000)
 
     def fmtDiff(self):
-        return "[   +{:06}]".format(self.lastDiff*50)
+        return "[   +{:06}]".format(self.lastDiff*self.tick_us)
 
 class TextOutput(object):
     """ formats single chars and integers to the terminal, including
@@ -295,12 +590,12 @@ class TextOutput(object):
 
 class TPIUParser(object):
     """ For details of the TPIU protocol see the Armv7-M Architecture Reference Manual """
-    gprof_hist = {}
-
-    def __init__(self, syms, flags, elfFiles=None):
+    def __init__(self, syms, flags, elfFiles=None, qfTimeline=False):
         self._sm = TPIUParserSM()
         self.syms = syms
         self._overflows = 0
+        self._totalOverflows = 0
+        self._syncLosses = 0
         self._sm.setEventPrinting(False)
         self._sm.eventHandlers["SIT"] = self.onSIT
         self._sm.eventHandlers["HSP_PC_SAMPLE"] = self.onPC
@@ -308,17 +603,25 @@ class TPIUParser(object):
         self._sm.eventHandlers["HSP_DATA_TRACE_PC"] = self.onPC
         self._sm.eventHandlers["HSP_DATA_TRACE_DATA"] = self.onData
         self._sm.eventHandlers["Overflow"] = self.onOverflow
+        self._sm.eventHandlers["SyncLost"] = self.onSyncLost
+        self._sm.eventHandlers["Sync"] = self.onSync
+        self._sm.eventHandlers["Marker"] = self.onMarker
         # next ones disabled for now as not used and noise/berr sets them off
         self._sm.eventHandlers["HSP_DATA_TRACE_OFFSET"] = self.onOffset
         #self._sm.eventHandlers["HSP_UNKNOWN"] = self.onUnknown
         self._term0 = TextOutput()
-        self._timestamp = TimeStamp()
+        self._timebase = TimeBase()
+        self._sm.timebase = self._timebase
         self._displayDataRead = ['r' in flag for flag in flags]
         self._displayDataWrite = ['w' in flag for flag in flags]
         self._dataUnique = ['u' in flag for flag in flags]
         self._lastData = [None for i in range(4)]
         self.addr2line = Address2LineResolver(elfFiles)
         self.addr2sym = Address2SymbolResolver(elfFiles)
+        self.funcHist = FunctionHistogram(self.addr2sym)
+        self.sleeps = 0
+        self.qf = QFAnalyser(self.addr2sym, keepTimeline=qfTimeline)
+        self.watchScheduler = None
 
     def getGprof(self):
         # return list(self.gprof_hist)
@@ -328,21 +631,58 @@ class TPIUParser(object):
         #  provided 'idle' function eg prvIdleTask.lto_priv.407
         #  for POD (pass in by cli argument), and list it separately
         #  so we can show CPU gas gauge, i.e. percent busy/idle
-        return self.gprof_hist
+        return self.funcHist.toDict()
+
+    def getStats(self):
+        """ stream health counters, i.e. sync packets, resyncs, discarded bytes and suspected false packets. """
+        stats = self._sm.getStats()
+        stats["overflows"] = self._totalOverflows
+        stats["timeGaps"] = self._timebase.gaps
+        stats["driftPpm"] = round(self._timebase.driftPpm(), 1)
+        return stats
 
     def parseValue(self, intValue):
-        self._sm.onRxByte(intValue)
+        self._sm.parseBytes(bytes((intValue,)))
         
-    def parseBytes(self, bytes): 
-        for intValue in bytes:
-            # iterate bytesarray gives INTS
-            self.parseValue(intValue)
+    def parseBytes(self, bytes, hostTime=None):
+        """ decode bytes (or a Marker), received from the target at hostTime, the time.monotonic()
+        of the read (see StlinkTrace.readSWOTimed).  Defaults to now, only right if decoding keeps up. """
+        self._timebase.setHostTime(time.monotonic() if hostTime is None else hostTime)
+        self._sm.parseBytes(bytes)
 
     def onOverflow(self, ev, data):
         self._overflows += 1
+        self._totalOverflows += 1
         if self._overflows > 50:
             self._overflows = 0
             print("!! getting overflows, increase baudrate or reduce tracing load.")
+
+    def onSyncLost(self, ev, data):
+        self._syncLosses += 1
+        if self._syncLosses > 50:
+            self._syncLosses = 0
+            print("!! stream corrupt, {} bytes discarded so far, check SWO wiring and baudrate.".format(
+                self._sm.discardedBytes))
+
+    def onSync(self, ev, data):
+        pass
+
+    def onMarker(self, ev, marker):
+        """probe reconfigured, from here on the stream reflects the new settings."""
+        if marker.command == "setWatch" and marker.tag and not marker.error:
+            sym, flags = marker.tag
+            self.setWatchDisplay(marker.args["index"], sym, flags)
+        if self.watchScheduler:
+            self.watchScheduler.onMarker(marker)
+        print("{}  ** {}".format(self._timebase.fmtAbs(), marker))
+
+    def setWatchDisplay(self, index, sym, flags):
+        """label and reporting flags (see --flags) for data events from DWT(index)."""
+        self.syms[index] = sym
+        self._displayDataRead[index] = 'r' in flags
+        self._displayDataWrite[index] = 'w' in flags
+        self._dataUnique[index] = 'u' in flags
+        self._lastData[index] = None
     
     def onUnknown(self, ev, hsp):
         print("UNKNOWN: disc {:02x} len {}".format(hsp.discriminator, hsp.expectedLth))
@@ -360,10 +700,17 @@ class TPIUParser(object):
 
     def onPC(self, ev, hsp):
         """Hardware Source Packet - PC value event"""
+        if ev == "HSP_PC_SAMPLE":
+            # profile, not the PC of a watched DWT access
+            if hsp.lth == 1:
+                # core sleeping, no PC
+                self.sleeps += 1
+                print("PC: sleeping")
+                return
+            # increment histogram bin for this function
+            self.funcHist.add(hsp.value)
         if self.addr2line:
             function_name = self.addr2line.resolve(hsp.value).rstrip("\r\n")
-            # increment histogram bin for this function
-            self.gprof_hist[function_name] = self.gprof_hist.get(function_name, 0) + 1
             where = "# " + function_name
         else:
             where = ""
@@ -372,6 +719,8 @@ class TPIUParser(object):
     def onData(self, ev, hsp):
         """Hardware Source Packet - data value event"""
         index = hsp.dwtIndex
+        if self.watchScheduler:
+            self.watchScheduler.onData(index, hsp.isWrite)
         if hsp.isWrite:
             if not self._displayDataWrite[index]:
                 return
@@ -407,27 +756,41 @@ class TPIUParser(object):
                 self._term0.updateInt(sit.sum)
         elif sit.chan == DBG_EV_PORT_TIMESTAMP:
             #timestamp
-            self._timestamp.update16(sit.sum)
-            print("{}  timer update".format(self._timestamp.fmtAbs()))
+            self._timebase.update(sit.sum, 8*sit.lth)
+            print("{}  timer update".format(self._timebase.fmtAbs()))
         elif sit.chan == DBG_EV_PORT_QFSIGDISPATCH:
             #qf dispatch
             if sit.lth == 1:
                 # timestamp byte
-                self._timestamp.update8(sit.sum)
+                self._timebase.update8(sit.sum)
                 pass
             elif sit.lth == 4:
                 # AO index plus signum
                 ao = sit.data[3]
                 sig = sit.data[0] + (sit.data[1]<<8) + (sit.data[2]<<16)
-                # print "{}  ao sig;  {:02x} -> {:04x}".format(self._timestamp.fmtDiff(), ao, sig)
-                print("{}  ao sig;  {:02x} -> {:04x}".format(self._timestamp.fmtAbs(), ao, sig))
+                # print "{}  ao sig;  {:02x} -> {:04x}".format(self._timebase.fmtDiff(), ao, sig)
+                print("{}  ao sig;  {:02x} -> {:04x}".format(self._timebase.fmtAbs(), ao, sig))
+                self.qf.onDispatch(sit.ticks, ao, sig, sit.hostTime)
+        elif sit.chan == DBG_EV_PORT_QFSIGCOMPLETE:
+            #qf run to completion finished
+            if sit.lth == 1:
+                # timestamp byte
+                self._timebase.update8(sit.sum)
+            elif sit.lth == 4:
+                # AO index plus signum
+                ao = sit.data[3]
+                sig = sit.data[0] + (sit.data[1]<<8) + (sit.data[2]<<16)
+                print("{}  ao done; {:02x} -> {:04x}".format(self._timebase.fmtAbs(), ao, sig))
+                self.qf.onComplete(sit.ticks, ao, sig, sit.hostTime)
         elif sit.chan == DBG_EV_PORT_QFSTATEENTRY:
             # AO new state address
             if sit.lth == 1:
                 # timestamp byte
-                self._timestamp.update8(sit.sum)
+                self._timebase.update8(sit.sum)
                 pass
             elif sit.lth == 4:
                 # address of new state
                 addr = sit.sum
-                print("{}  QTRAN addr {:08x}{}".format(self._timestamp.fmtAbs(), addr, self.addr2sym.addr2FormattedName(addr)))
+                print("{}  QTRAN addr {:08x}{}".format(self._timebase.fmtAbs(), addr,
+                                                        self.addr2sym.addr2FormattedName(addr)))
+                self.qf.onStateEntry(sit.ticks, addr)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+  Time multiplexing of the four DWT comparators over any number of watch
+  symbols.
+
+  Every slice the scheduler picks which watches own the free comparators and
+  queues the changes through StlinkTrace (applied live by the pump thread).
+  A watch only counts as active from the Marker confirming its setWatch, so
+  data events are attributed to the symbol that was really on the comparator
+  at that point in the stream, and coverage is measured from the same point.
+
+  Policies:
+    round-robin  rotate through the watches in order
+    priority     stride scheduling, each watch gets comparator time in
+                 proportion to its priority
+    rate         as priority, but scaled down by the write rate seen so far,
+                 so rarely written variables get longer on a comparator and
+                 busy ones (whose behaviour shows quickly) give way
+"""
+
+import time
+
+POLICIES = ["round-robin", "priority", "rate"]
+
+
+class ScheduledWatch(object):
+    """one symbol to be watched, and its coverage so far."""
+
+    def __init__(self, sym, flags="dp", priority=1.0):
+        self.sym = sym
+        self.flags = flags
+        self.priority = priority
+        self.credit = 0.0
+        self.slices = 0
+        self.active_s = 0.0
+        self.activeSince = None
+        self.events = 0
+        self.writes = 0
+
+    @classmethod
+    def parse(cls, spec):
+        """from a --watch argument, SYM[:flags[:priority]].  Raises ValueError if malformed."""
+        parts = spec.split(":")
+        if not parts[0] or len(parts) > 3:
+            raise ValueError("expected SYM[:flags[:priority]], got {!r}".format(spec))
+        flags = parts[1] if len(parts) > 1 and parts[1] else "dp"
+        try:
+            priority = float(parts[2]) if len(parts) > 2 else 1.0
+        except ValueError:
+            raise ValueError("priority of {!r} is not a number".format(spec))
+        if not priority > 0:
+            raise ValueError("priority of {!r} must be greater than 0".format(spec))
+        return cls(parts[0], flags, priority)
+
+    def activeTime(self, now):
+        if self.activeSince is None:
+            return self.active_s
+        return self.active_s + now - self.activeSince
+
+    def writeRate(self, now):
+        t = self.activeTime(now)
+        return self.writes / t if t else 0
+
+
+class WatchScheduler(object):
+    """Rotates watches through the given DWT comparators every slice_s seconds."""
+
+    def __init__(self, watchPointMgr, watches, comparators=(0, 1, 2, 3), slice_s=1.0, policy="round-robin"):
+        self.watchPointMgr = watchPointMgr
+        self.watches = []
+        for w in watches:
+            if watchPointMgr.elfinspector.name2addr(w.sym) is None:
+                print("!! no symbol {} in elf files, not watching it".format(w.sym))
+            else:
+                self.watches.append(w)
+        self.comparators = list(comparators)
+        self.slice_s = slice_s
+        self.policy = policy
+        self._assigned = {}   # comparator -> watch requested
+        self._active = {}     # comparator -> watch confirmed by marker
+        self._next = 0
+        self._rotation = 0
+        self._start = time.monotonic()
+
+    def poll(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now >= self._next and self.watches and self.comparators:
+            self._next = now + self.slice_s
+            self.schedule(now)
+
+    def _choose(self, now):
+        n = min(len(self.comparators), len(self.watches))
+        if self.policy == "round-robin":
+            chosen = [self.watches[(self._rotation + i) % len(self.watches)] for i in range(n)]
+            self._rotation = (self._rotation + n) % len(self.watches)
+            return chosen
+        earned = 0.0
+        for w in self.watches:
+            weight = w.priority
+            if self.policy == "rate":
+                weight /= 1.0 + w.writeRate(now) * self.slice_s
+            w.credit += weight
+            earned += weight
+        chosen = sorted(self.watches, key=lambda w: w.credit, reverse=True)[:n]
+        for w in chosen:
+            # the slice costs what every watch earned this round, shared by those running
+            w.credit -= earned / n
+        return chosen
+
+    def schedule(self, now):
+        chosen = self._choose(now)
+        # leave watches that stay chosen on the comparator they already have
+        keep = {c: w for c, w in self._assigned.items() if w in chosen}
+        incoming = [w for w in chosen if w not in keep.values()]
+        for c in self.comparators:
+            w = keep.get(c)
+            if w is None and incoming:
+                w = incoming.pop(0)
+                # explicit size, setupWatch defaults a missing one to 4 bytes
+                size = self.watchPointMgr.elfinspector.name2size(w.sym)
+                self.watchPointMgr.setupWatch(c, w.sym, None, size, w.flags)
+            elif w is None and c in self._assigned:
+                self.watchPointMgr.clearWatch(c)
+            if w is None:
+                self._assigned.pop(c, None)
+            else:
+                self._assigned[c] = w
+                w.slices += 1
+
+    def onMarker(self, marker):
+        """a setWatch took effect, switch the comparator's coverage accounting over."""
+        if marker.command != "setWatch" or marker.error:
+            return
+        c = marker.args["index"]
+        if c not in self.comparators:
+            return
+        now = marker.hostTime if marker.hostTime is not None else time.monotonic()
+        prev = self._active.pop(c, None)
+        if prev:
+            prev.active_s += now - prev.activeSince
+            prev.activeSince = None
+        sym = marker.tag[0] if marker.tag else None
+        for w in self.watches:
+            if w.sym == sym:
+                w.activeSince = now
+                self._active[c] = w
+
+    def onData(self, index, isWrite):
+        w = self._active.get(index)
+        if w:
+            w.events += 1
+            if isWrite:
+                w.writes += 1
+
+    def formatReport(self):
+        now = time.monotonic()
+        run_s = now - self._start
+        lines = ["watch coverage over {:.1f}s, {} watches on comparators {}, {} policy".format(
+            run_s, len(self.watches), self.comparators, self.policy)]
+        lines.append("  {:<28} {:>8} {:>9} {:>7} {:>8} {:>8} {:>9}".format(
+            "symbol", "prio", "active s", "cover", "slices", "events", "writes/s"))
+        for w in self.watches:
+            t = w.activeTime(now)
+            lines.append("  {:<28} {:>8.1f} {:>9.1f} {:>6.1f}% {:>8} {:>8} {:>9.1f}".format(
+                w.sym, w.priority, t, 100.0 * t / run_s if run_s else 0, w.slices, w.events, w.writeRate(now)))
+        return "\n".join(lines)